@@ -10,14 +10,167 @@ import os
 import sys
 import json
 import re
+import mmap
 import subprocess
 import argparse
+import logging
+import logging.handlers
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # orjson为可选依赖，可直接解析bytes且速度更快
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    'remove_first_9_bytes_if_zero',
+    'get_media_info',
+    'save_audio_file',
+    'merge_m4s_to_mp4_with_ffmpeg',
+    'merge_m4s_batch_with_ffmpeg',
+    'read_json_data',
+    'process_directory',
+    'clean_Win_illegal_chars',
+    'main',
+]
+
+# 分块读写时使用的缓冲区大小（远大于io.DEFAULT_BUFFER_SIZE）
+_CHUNK_SIZE = 1 << 20
+# Bilibili缓存文件开头附加的9个字符'0'（0x30）
+_ZERO9 = b'0' * 9
+# 在文件开头的这段范围内查找hdlr box
+_HDLR_SCAN_LIMIT = 1 << 16
+_HANDLER_KINDS = {b'vide': 'video', b'soun': 'audio'}
+# 单个FFmpeg进程中批量合并的最大视频数
+_MERGE_BATCH_SIZE = 30
+# 批量合并命令行的长度上限（Windows命令行限制为32767个字符）
+_MAX_CMDLINE_LENGTH = 30000
+# 每个合并任务除文件路径外附加的参数长度估计
+_MERGE_JOB_OVERHEAD = 128
+# get_media_info缓存的最大条目数
+_MEDIA_INFO_CACHE_SIZE = 4096
+# Windows文件名中的非法字符
+_WIN_ILLEGAL_CHARS = re.compile(r'[<>:"/\\|?*]')
+
+_media_info_cache = {}
+# 已创建的输出目录（每个进程各自记录），避免对同一组标题目录重复调用makedirs
+_made_dirs = set()
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _shift_left_in_place(fd, offset, size):
+    """
+    将文件中offset之后的内容整体前移offset个字节，并截断文件末尾
+
+    参数:
+    fd: 以读写方式打开的文件描述符
+    offset: 需要删除的前导字节数
+    size: 原文件大小
+    """
+    try:
+        # 在映射内存中直接memmove，不需要额外的用户态缓冲区
+        with mmap.mmap(fd, 0) as mm:
+            mm.move(0, offset, size - offset)
+    except (OSError, ValueError):
+        # 部分FUSE/网络文件系统不支持可写的共享映射，
+        # 文件超出地址空间时也无法映射，改为分块读写前移
+        _shift_left_chunked(fd, offset, size)
+    # 先关闭映射再截断（Windows不允许截断仍被映射的文件）
+    os.ftruncate(fd, size - offset)
+
+
+def _shift_left_chunked(fd, offset, size):
+    pos = 0
+    while pos + offset < size:
+        os.lseek(fd, pos + offset, os.SEEK_SET)
+        chunk = os.read(fd, _CHUNK_SIZE)
+        if not chunk:
+            break
+        os.lseek(fd, pos, os.SEEK_SET)
+        _write_all(fd, chunk)
+        pos += len(chunk)
+
+
+def _copy_range(src_fd, dst_fd, offset, count):
+    """
+    从src_fd的offset处复制count个字节到dst_fd，优先在内核中完成复制
+
+    参数:
+    src_fd: 源文件描述符
+    dst_fd: 目标文件描述符
+    offset: 源文件起始偏移
+    count: 需要复制的字节数
+    """
+    # copy_file_range可利用reflink等机制，其次是sendfile
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(
+            lambda n, off: os.copy_file_range(src_fd, dst_fd, n, off))
+    if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        kernel_copies.append(
+            lambda n, off: os.sendfile(dst_fd, src_fd, off, n))
+
+    for kernel_copy in kernel_copies:
+        try:
+            while count > 0:
+                copied = kernel_copy(count, offset)
+                if copied == 0:
+                    # 未复制任何数据时不能当作结束，交给下一种方式处理
+                    break
+                offset += copied
+                count -= copied
+        except OSError:
+            # 文件系统不支持时尝试下一种方式，最后退回到普通的分块复制
+            continue
+        if count <= 0:
+            return
+
+    if count <= 0:
+        return
+    # 映射源文件后直接从映射内存写出，避免先读入一份用户态副本
+    with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as mm:
+        end = offset + count
+        if end > len(mm):
+            raise OSError(f"源文件长度不足，缺少{end - len(mm)}字节")
+        with memoryview(mm) as view:
+            while offset < end:
+                stop = min(offset + _CHUNK_SIZE, end)
+                _write_all(dst_fd, view[offset:stop])
+                offset = stop
+
+
+def _same_file(stat_a, stat_b):
+    return (stat_a.st_dev, stat_a.st_ino) == (stat_b.st_dev, stat_b.st_ino)
+
+
+def _copy_to_file(src_fd, output_file, offset, count):
+    # 不使用O_TRUNC打开，确认不是同一个文件后再截断，防止先清空了源文件
+    flags = os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    dst_fd = os.open(output_file, flags, 0o666)
+    try:
+        if _same_file(os.fstat(src_fd), os.fstat(dst_fd)):
+            raise ValueError(f"输出文件与输入文件相同: {output_file}")
+        os.ftruncate(dst_fd, 0)
+        _copy_range(src_fd, dst_fd, offset, count)
+    finally:
+        os.close(dst_fd)
 
 
 def remove_first_9_bytes_if_zero(input_file, output_file=None):
     """
     读取二进制文件，如果前9个字节都是字符'0'，则删除它们并保存剩余部分
 
+    只读取前9个字节进行判断；覆盖原文件时原地前移数据并截断，
+    输出到其他文件时直接在内核中复制，不会把整个文件读入内存。
+
     参数:
     input_file: 输入文件路径
     output_file: 输出文件路径（如果为None，则覆盖原文件）
@@ -25,66 +178,143 @@ def remove_first_9_bytes_if_zero(input_file, output_file=None):
     返回:
     bool: 是否成功删除了前9个字节
     """
+    # 检查文件名是否.m4s，不符合时无需访问文件
+    if not input_file.lower().endswith('.m4s'):
+        logger.warning("文件扩展名不是.m4s，跳过处理")
+        return False
+
+    in_place = output_file is None
+    binary = getattr(os, 'O_BINARY', 0)
     try:
-        # 读取输入文件
-        with open(input_file, 'rb') as f:
-            data = f.read()
+        size = os.stat(input_file).st_size
 
         # 检查文件大小是否至少有9个字节
-        if len(data) < 9:
-            print("文件大小小于9字节，无法判断前9个字节")
+        if size < 9:
+            logger.warning("文件大小小于9字节，无法判断前9个字节")
             return False
 
-        # 检查文件名是否.m4s
-        if not input_file.lower().endswith('.m4s'):
-            print("文件扩展名不是.m4s，跳过处理")
-            return False
+        fd = os.open(input_file, os.O_RDONLY | binary)
+        try:
+            # 输出路径与输入指向同一文件时（如相对/绝对路径、链接）按覆盖原文件处理
+            if not in_place:
+                try:
+                    in_place = _same_file(os.fstat(fd), os.stat(output_file))
+                except OSError:
+                    pass
+
+            # 检查前9个字节是否都是字符'0'（ASCII码为48）
+            # 字符'0'的二进制表示为0x30
+            # 只读取前9个字节，不符合时直接返回，不会读取文件其余部分
+            if os.read(fd, 9) != _ZERO9:
+                logger.debug("前9个字节不全是字符'0'，不进行删除操作")
+
+                # 如果指定了输出文件且不是覆盖原文件，则复制文件
+                if not in_place:
+                    _copy_to_file(fd, output_file, 0, size)
+                    logger.info("已复制文件到: %s", output_file)
+
+                return False
+
+            logger.debug("前9个字节都是字符'0'，正在删除...")
+            if not in_place:
+                _copy_to_file(fd, output_file, 9, size - 9)
+        finally:
+            os.close(fd)
+
+        if in_place:
+            # 确定需要修改后才以读写方式打开
+            fd = os.open(input_file, os.O_RDWR | binary)
+            try:
+                _shift_left_in_place(fd, 9, size)
+            finally:
+                os.close(fd)
+
+        logger.debug("已删除前9个字节，原文件大小: %d字节，新文件大小: %d字节",
+                     size, size - 9)
+        return True
 
-        # 检查前9个字节是否都是字符'0'（ASCII码为48）
-        # 字符'0'的二进制表示为0x30
-        is_all_zero = all(byte == 0x30 for byte in data[:9])
+    except FileNotFoundError:
+        logger.error("错误: 文件 '%s' 未找到", input_file)
+        return False
+    except Exception as e:
+        logger.error("处理文件时发生错误: %s", e)
+        return False
 
-        if is_all_zero:
-            print("前9个字节都是字符'0'，正在删除...")
-            # 删除前9个字节
-            new_data = data[9:]
 
-            # 确定输出文件路径
-            if output_file is None:
-                output_file = input_file
+def _detect_m4s_kind(file_path):
+    """
+    读取分片MP4中hdlr box的handler_type，判断.m4s文件是视频还是音频
 
-            # 写入输出文件
-            with open(output_file, 'wb') as f:
-                f.write(new_data)
+    返回:
+        str: 'video'或'audio'，无法判断时返回None
+    """
+    try:
+        with open(file_path, 'rb', buffering=0) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = mm.find(b'hdlr', 0, _HDLR_SCAN_LIMIT)
+                if pos < 0:
+                    return None
+                # 'hdlr'之后依次为version/flags(4)、pre_defined(4)、handler_type(4)
+                return _HANDLER_KINDS.get(mm[pos + 12:pos + 16])
+    except (OSError, ValueError):
+        return None
 
-            print(f"已删除前9个字节，原文件大小: {len(data)}字节，新文件大小: {len(new_data)}字节")
-            return True
-        else:
-            print("前9个字节不全是字符'0'，不进行删除操作")
 
-            # 如果指定了输出文件且不是覆盖原文件，则复制文件
-            if output_file and output_file != input_file:
-                with open(output_file, 'wb') as f:
-                    f.write(data)
-                print(f"已复制文件到: {output_file}")
+def _find_audio_candidate(m4s_files):
+    """
+    找出最可能是音频的.m4s文件
 
-            return False
+    优先根据hdlr box判断；无法判断时取体积最小的文件（音频通常远小于视频）
 
-    except FileNotFoundError:
-        print(f"错误: 文件 '{input_file}' 未找到")
-        return False
-    except Exception as e:
-        print(f"处理文件时发生错误: {e}")
-        return False
+    返回:
+        str: 候选音频文件路径，全部确定为视频或无法访问时返回None
+    """
+    unknown = []
+    for m4s_file in m4s_files:
+        kind = _detect_m4s_kind(m4s_file)
+        if kind == 'audio':
+            return m4s_file
+        if kind is None:
+            try:
+                # 失效的链接或已被删除的文件直接跳过
+                unknown.append((os.path.getsize(m4s_file), m4s_file))
+            except OSError:
+                continue
+    if not unknown:
+        return None
+    return min(unknown)[1]
 
 
 def get_media_info(file_path):
     """
     使用ffprobe获取媒体文件信息，区分视频和音频文件
 
+    成功的结果按(路径, 修改时间, 大小)缓存，文件未变化时不会重复调用ffprobe；
+    失败不缓存。返回的字典为共享对象，不应修改
+
     返回:
         dict: 包含流类型、编码器、时长等信息
     """
+    try:
+        st = os.stat(file_path)
+        key = (str(file_path), st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    if key in _media_info_cache:
+        return _media_info_cache[key]
+
+    info = _probe_media_info(file_path)
+    if info is not None and key is not None:
+        if len(_media_info_cache) >= _MEDIA_INFO_CACHE_SIZE:
+            # 缓存已满时淘汰最早加入的一项
+            del _media_info_cache[next(iter(_media_info_cache))]
+        _media_info_cache[key] = info
+    return info
+
+
+def _probe_media_info(file_path):
     try:
         cmd = [
             'ffprobe',
@@ -95,8 +325,7 @@ def get_media_info(file_path):
             str(file_path)
         ]
 
-        result = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=10)
+        result = subprocess.run(cmd, capture_output=True, timeout=10)
 
         if result.returncode == 0:
             info = json.loads(result.stdout)
@@ -107,146 +336,233 @@ def get_media_info(file_path):
                     'size': int(info['format']['size']),
                     }
         else:
-            print(f"    ffprobe错误: {result.stderr[:200]}")
+            error = result.stderr[:200].decode('utf-8', 'replace')
+            logger.error("    ffprobe错误: %s", error)
             return None
     except Exception as e:
-        print(f"    获取媒体信息出错: {e}")
-        print(info)
+        logger.error("    获取媒体信息出错: %s", e)
         return None
 
 
-def save_audio_file(m4s_file, info, title, group_title, output_path):
+def _build_output_path(output_path, title, group_title, sufix):
     """
-    保存音频数据到指定路径
+    构建输出文件路径，组标题与标题不同时放到组标题子目录下
+    """
+    if not group_title or group_title == title:
+        return os.path.join(output_path, f"{title}.{sufix}")
+    return os.path.join(output_path, group_title, f"{title}.{sufix}")
 
-    参数:
-        audio_data: 音频二进制数据
-        output_path: 输出文件路径
+
+def _ensure_output_dir(output_file):
     """
-    if not title:
-        print("    标题为空，无法保存音频文件")
+    在写入输出文件前创建其所在目录，本进程已创建过的目录不再重复创建
+
+    返回:
+        bool: 目录是否可用
+    """
+    directory = os.path.dirname(output_file)
+    if not directory or directory in _made_dirs:
+        return True
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logger.error("无法创建输出目录 %s: %s", directory, e)
         return False
+    _made_dirs.add(directory)
+    return True
 
-    sufix = 'm4a' if info['codec_name'] == 'aac' else info['codec_name']
-    # 构建输出文件路径
-    if not group_title or group_title == title:
-        output_path = os.path.join(output_path, f"{title}.{sufix}")
-    else:
-        output_path = os.path.join(
-            output_path, group_title, f"{title}.{sufix}")
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    try:
-        # 构建FFmpeg命令
-        # -f concat: 指定使用concat解复用器
-        # -safe 0: 允许使用所有文件名
-        # -c copy: 流复制模式，不重新编码
-        cmd = [
-            'ffmpeg',
-            '-i', m4s_file,
-            '-c', 'copy',  # 复制所有流而不重新编码
-            '-y',  # 覆盖已存在的输出文件
-            output_path
-        ]
+def _build_ffmpeg_cmd(input_files, outputs):
+    """
+    构建流复制模式的FFmpeg命令
 
-        print(f"    执行FFmpeg命令: {' '.join(cmd)}")
+    参数:
+        input_files: 输入文件列表
+        outputs: (输出参数列表, 输出文件路径)的列表，可包含多个输出
+    """
+    # -y: 覆盖已存在的输出文件
+    cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y']
+    for input_file in input_files:
+        # 输入已知为分片MP4，编码参数都在文件开头的moov中，
+        # 限制格式探测与流分析最多读取32KB数据
+        cmd += ['-probesize', '32k', '-i', input_file]
+    for output_args, output_path in outputs:
+        cmd += output_args
+        cmd += ['-c', 'copy']  # 复制所有流而不重新编码
+        # 时间戳从0开始，避免负时间戳触发额外的重写处理
+        cmd += ['-avoid_negative_ts', 'make_zero']
+        cmd.append(output_path)
+    return cmd
+
+
+def _run_ffmpeg(cmd, output_paths, success_msg, failure_msg, timeout=300):
+    """
+    执行FFmpeg命令并输出结果
+
+    返回:
+        bool: 是否执行成功；FFmpeg未能运行（找不到程序、超时等）时返回None
+    """
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("    执行FFmpeg命令: %s", ' '.join(cmd))
 
         # 执行FFmpeg命令
+        # 标准输出无用直接丢弃，错误输出仅在失败时解码
         result = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=300)
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            timeout=timeout)
 
         if result.returncode == 0:
-            print(f"    ✓ 音频文件已保存到: {os.path.basename(output_path)}")
-            # 检查输出文件大小
-            if os.path.exists(output_path):
-                size = os.path.getsize(output_path) / (1024 * 1024)  # 转换为MB
-                print(f"    输出文件大小: {size:.2f} MB")
+            for output_path in output_paths:
+                logger.info("    ✓ %s: %s", success_msg,
+                            os.path.basename(output_path))
+                # 检查输出文件大小
+                if os.path.exists(output_path):
+                    size = os.path.getsize(output_path) / (1024 * 1024)  # 转换为MB
+                    logger.info("    输出文件大小: %.2f MB", size)
             return True
         else:
-            print("    ✗ FFmpeg输出失败:")
-            print(f"      错误输出: {result.stderr[:500]}")  # 只显示前500字符
+            logger.error("    ✗ %s:", failure_msg)
+            error = result.stderr[:500].decode('utf-8', 'replace')  # 只显示前500字节
+            logger.error("      错误输出: %s", error)
             return False
+
     except subprocess.TimeoutExpired:
-        print("    ✗ FFmpeg执行超时")
-        return False
+        logger.error("    ✗ FFmpeg执行超时")
+        return None
     except Exception as e:
-        print(f"    ✗ 执行FFmpeg时出错: {e}")
-        return False
+        logger.error("    ✗ 执行FFmpeg时出错: %s", e)
+        return None
 
 
-def merge_m4s_to_mp4_with_ffmpeg(m4s_files, title, group_title, output_path):
+def save_audio_file(m4s_file, info, title, group_title, output_path):
     """
-    使用FFmpeg合并多个.m4s文件为一个MP4文件
+    保存音频数据到指定路径
 
     参数:
-        m4s_files: .m4s文件列表
-        output_path: 输出MP4文件路径
+        audio_data: 音频二进制数据
+        output_path: 输出文件路径
     """
-    if len(m4s_files) < 2:
-        print("需要至少两个.m4s文件进行合并")
+    if not title:
+        logger.warning("    标题为空，无法保存音频文件")
         return False
+
+    sufix = 'm4a' if info['codec_name'] == 'aac' else info['codec_name']
+    output_path = _build_output_path(output_path, title, group_title, sufix)
+    if not _ensure_output_dir(output_path):
+        return False
+
+    output_args = []
+    if sufix == 'm4a':
+        output_args += ['-movflags', '+faststart']  # moov前置，便于边下边播
+    cmd = _build_ffmpeg_cmd([m4s_file], [(output_args, output_path)])
+    return bool(_run_ffmpeg(cmd, [output_path], "音频文件已保存到",
+                            "FFmpeg输出失败"))
+
+
+def _prepare_merge(m4s_files, title, group_title, output_path):
+    """
+    检查待合并的.m4s文件并确定输出路径
+
+    返回:
+        tuple: (视频文件, 音频文件, 输出MP4文件路径)，无法合并时返回None
+    """
+    if len(m4s_files) < 2:
+        logger.warning("需要至少两个.m4s文件进行合并")
+        return None
     # 假设第一个.m4s文件是视频，第二个是音频
     videofile = m4s_files[0]
     audiofile = m4s_files[1]
 
     if not os.path.exists(videofile):
-        print(f"视频文件不存在: {videofile}")
-        return False
+        logger.warning("视频文件不存在: %s", videofile)
+        return None
 
     if not os.path.exists(audiofile):
-        print(f"音频文件不存在: {audiofile}")
-        return False
+        logger.warning("音频文件不存在: %s", audiofile)
+        return None
 
     if not title:
-        print("标题为空，无法继续合并")
-        return False
+        logger.warning("标题为空，无法继续合并")
+        return None
 
-    # 构建输出文件路径
-    if not group_title or group_title == title:
-        output_path = os.path.join(output_path, f"{title}.mp4")
-    else:
-        output_path = os.path.join(output_path, group_title, f"{title}.mp4")
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    output_path = _build_output_path(output_path, title, group_title, 'mp4')
+    if not _ensure_output_dir(output_path):
+        return None
+    return videofile, audiofile, output_path
 
-    try:
-        # 构建FFmpeg命令
-        # -f concat: 指定使用concat解复用器
-        # -safe 0: 允许使用所有文件名
-        # -c copy: 流复制模式，不重新编码
-        cmd = [
-            'ffmpeg',
-            '-i', videofile,
-            '-i', audiofile,
-            '-c', 'copy',  # 复制所有流而不重新编码
-            '-y',  # 覆盖已存在的输出文件
-            output_path
-        ]
 
-        print(f"    执行FFmpeg命令: {' '.join(cmd)}")
+def merge_m4s_to_mp4_with_ffmpeg(m4s_files, title, group_title, output_path):
+    """
+    使用FFmpeg合并多个.m4s文件为一个MP4文件
+
+    参数:
+        m4s_files: .m4s文件列表
+        output_path: 输出MP4文件路径
+    """
+    job = _prepare_merge(m4s_files, title, group_title, output_path)
+    if job is None:
+        return False
+    return merge_m4s_batch_with_ffmpeg([job])
 
-        # 执行FFmpeg命令
-        result = subprocess.run(
-            cmd, capture_output=True, text=True, timeout=300)
 
-        if result.returncode == 0:
-            print(f"    ✓ 成功合并为: {os.path.basename(output_path)}")
-            # 检查输出文件大小
-            if os.path.exists(output_path):
-                size = os.path.getsize(output_path) / (1024 * 1024)  # 转换为MB
-                print(f"    输出文件大小: {size:.2f} MB")
-            return True
-        else:
-            print("    ✗ FFmpeg合并失败:")
-            print(f"      错误输出: {result.stderr[:500]}")  # 只显示前500字符
-            return False
+def merge_m4s_batch_with_ffmpeg(jobs):
+    """
+    在一个FFmpeg进程中完成多组.m4s文件的合并，省去逐个启动FFmpeg的开销
 
-    except subprocess.TimeoutExpired:
-        print("    ✗ FFmpeg执行超时")
-        return False
-    except Exception as e:
-        print(f"    ✗ 执行FFmpeg时出错: {e}")
+    参数:
+        jobs: (视频文件, 音频文件, 输出MP4文件路径)的列表
+
+    返回:
+        bool: 是否全部合并成功
+    """
+    inputs = []
+    outputs = []
+    for i, (videofile, audiofile, output_path) in enumerate(jobs):
+        inputs += [videofile, audiofile]
+        # 多输出时需显式指定每个输出使用的输入；按流类型映射，
+        # 无论.m4s文件的列举顺序如何，视频轨总在音频轨之前
+        maps = []
+        for stream_type in ('v', 'a'):
+            for index in (2 * i, 2 * i + 1):
+                maps += ['-map', f'{index}:{stream_type}?']
+        maps += ['-movflags', '+faststart']  # moov前置，便于边下边播
+        outputs.append((maps, output_path))
+    cmd = _build_ffmpeg_cmd(inputs, outputs)
+    output_paths = [output_path for _, _, output_path in jobs]
+    result = _run_ffmpeg(cmd, output_paths, "成功合并为", "FFmpeg合并失败",
+                         timeout=300 * len(jobs))
+    if result:
+        return True
+    # 仅当FFmpeg确实运行并返回非零时才逐个重试；
+    # 找不到FFmpeg或执行超时时，逐个重试只会重复同样的失败
+    if result is None or len(jobs) == 1:
         return False
 
+    # 批量合并失败时逐个重试，避免个别损坏文件影响同批的其他视频
+    logger.warning("    批量合并失败，改为逐个合并")
+    results = [merge_m4s_batch_with_ffmpeg([job]) for job in jobs]
+    return all(results)
+
+
+def _split_merge_batches(jobs, batch_size):
+    """
+    按数量和命令行长度将合并任务分批，避免超出系统的命令行长度限制
+    """
+    batch = []
+    length = 0
+    for job in jobs:
+        job_length = sum(len(path) for path in job) + _MERGE_JOB_OVERHEAD
+        if batch and (len(batch) >= batch_size or
+                      length + job_length > _MAX_CMDLINE_LENGTH):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(job)
+        length += job_length
+    if batch:
+        yield batch
+
 
 def read_json_data(json_file_path):
     """
@@ -259,31 +575,133 @@ def read_json_data(json_file_path):
     tuple: (title, groupTitle) 如果成功读取，否则返回(None, None)
     """
     try:
-        with open(json_file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(json_file_path, 'rb') as f:
+            data = _json_loads(f.read())
 
         title = clean_Win_illegal_chars(data.get('title', ''))
         group_title = clean_Win_illegal_chars(data.get('groupTitle', ''))
 
-        print("  读取JSON数据:")
-        print(f"    标题: {title}")
-        print(f"    组标题: {group_title}")
+        logger.info("  读取JSON数据:")
+        logger.info("    标题: %s", title)
+        logger.info("    组标题: %s", group_title)
 
         return title, group_title
     except Exception as e:
-        print(f"  读取JSON文件时发生错误: {e}")
+        logger.error("  读取JSON文件时发生错误: %s", e)
         return None, None
 
 
+def _read_dir_info(item_path):
+    """
+    读取数字子目录中的videoInfo.json
+
+    返回:
+    tuple: (title, groupTitle)
+    """
+    logger.info("处理子目录: %s", item_path)
+
+    # 读取JSON文件
+    json_file_path = os.path.join(item_path, 'videoInfo.json')
+    return read_json_data(json_file_path)
+
+
+def _process_one_dir(item_path, title, group_title, output_path,
+                     process_mode, audio_output_path):
+    """
+    处理单个数字子目录：删除.m4s文件头，按需导出音频
+
+    参数:
+    item_path: 子目录路径
+    title: 标题
+    group_title: 组标题
+    output_path: 视频输出目录
+    process_mode: 处理模式集合（"video"、"audio"）
+    audio_output_path: 音频输出目录
+
+    返回:
+    tuple: 待执行的合并任务，无需合并时返回None
+    """
+    # 单个子目录出错时只记录错误，不影响其他子目录及已收集的合并任务
+    try:
+        # 处理.m4s文件
+        m4s_list = []
+        with os.scandir(item_path) as it:
+            entries = list(it)
+        for entry in entries:
+            if entry.name.lower().endswith('.m4s'):
+                m4s_file_path = entry.path
+                m4s_list.append(m4s_file_path)
+                logger.info("  处理文件: %s", m4s_file_path)
+                remove_first_9_bytes_if_zero(m4s_file_path)
+        # 准备合并任务，由调用方与其他子目录的任务一起批量合并
+        merge_job = None
+        if 'video' in process_mode:
+            merge_job = _prepare_merge(
+                m4s_list, title, group_title, output_path)
+        # 处理音频
+        if 'audio' in process_mode:
+            # 每个子目录只有一个音频文件，只对最可能的候选调用ffprobe确认
+            audio_file = _find_audio_candidate(m4s_list)
+            if audio_file:
+                info = get_media_info(audio_file)
+                if info and info['codec_type'] == 'audio':
+                    save_audio_file(
+                        audio_file, info, title, group_title,
+                        audio_output_path)
+        return merge_job
+    except Exception as e:
+        logger.error("处理子目录 %s 时发生错误: %s", item_path, e)
+        return None
+
+
+class _RecordCollector(logging.handlers.QueueHandler):
+    """
+    收集日志记录，QueueHandler会先把消息格式化好，保证记录可以pickle
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self.records = []
+
+    def enqueue(self, record):
+        self.records.append(record)
+
+
+def _capture_logs(level, func, *args):
+    """
+    在子进程中执行func，返回其日志记录和返回值，便于主进程按顺序输出
+    """
+    collector = _RecordCollector()
+    old_level, old_propagate = logger.level, logger.propagate
+    # 子进程不一定继承主进程的日志配置，按主进程的级别过滤
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(collector)
+    try:
+        result = func(*args)
+    finally:
+        logger.removeHandler(collector)
+        logger.setLevel(old_level)
+        logger.propagate = old_propagate
+    return collector.records, result
+
+
+def _replay_logs(records):
+    for record in records:
+        logger.handle(record)
+
+
 def process_directory(base_dir, output_path=None,
-                      process_mode={"video"}, audio_output_path=None):
+                      process_mode={"video"}, audio_output_path=None,
+                      max_workers=None):
     """
     处理指定目录下的所有数字子目录
 
     参数:
     base_dir: 基础目录路径
+    max_workers: 并行处理的进程数，默认为CPU核心数，为1时串行处理
     """
-    print(f"开始处理目录: {base_dir}")
+    logger.info("开始处理目录: %s", base_dir)
 
     if output_path is None:
         output_path = os.path.join(base_dir, "bili_video_output")
@@ -294,55 +712,85 @@ def process_directory(base_dir, output_path=None,
         os.makedirs(audio_output_path, exist_ok=True)
 
     # 获取基础目录下的所有子目录
+    # scandir可直接从目录项得到文件类型，无需对每一项再调用stat
     try:
-        items = os.listdir(base_dir)
+        with os.scandir(base_dir) as it:
+            entries = list(it)
     except Exception as e:
-        print(f"无法读取目录 {base_dir}: {e}")
+        logger.error("无法读取目录 %s: %s", base_dir, e)
         return
 
-    for item in items:
-        item_path = os.path.join(base_dir, item)
-
+    item_paths = []
+    for entry in entries:
         # 检查是否为目录且名称为数字
-        if os.path.isdir(item_path) and re.fullmatch(r'\d+', item):
-            print(f"处理子目录: {item_path}")
-
-            # 读取JSON文件
-            json_file_path = os.path.join(item_path, 'videoInfo.json')
-            title, group_title = read_json_data(json_file_path)
-
-            # 处理.m4s文件
-            m4s_list = []
-            for file_name in os.listdir(item_path):
-                if file_name.lower().endswith('.m4s'):
-                    m4s_file_path = os.path.join(item_path, file_name)
-                    m4s_list.append(m4s_file_path)
-                    print(f"  处理文件: {m4s_file_path}")
-                    remove_first_9_bytes_if_zero(m4s_file_path)
-            # 调用合并函数
-            if 'video' in process_mode:
-                merge_m4s_to_mp4_with_ffmpeg(
-                    m4s_list, title, group_title, output_path)
-            # 处理音频
-            if 'audio' in process_mode:
-                for m4s_file in m4s_list:
-                    info = get_media_info(m4s_file)
-                    if info and info['codec_type'] == 'audio':
-                        save_audio_file(
-                            m4s_file, info, title, group_title,
-                            audio_output_path)
+        # isdecimal与正则\d匹配的字符集一致
+        if entry.name.isdecimal() and entry.is_dir():
+            item_paths.append(entry.path)
         else:
-            print(f"跳过非数字目录或文件: {item_path}")
-    print("目录处理完成。")
+            logger.info("跳过非数字目录或文件: %s", entry.path)
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = min(max_workers, len(item_paths))
+
+    merge_jobs = []
+    if max_workers <= 1:
+        for item_path in item_paths:
+            title, group_title = _read_dir_info(item_path)
+            merge_job = _process_one_dir(item_path, title, group_title,
+                                         output_path, process_mode,
+                                         audio_output_path)
+            if merge_job:
+                merge_jobs.append(merge_job)
+        for batch in _split_merge_batches(merge_jobs, _MERGE_BATCH_SIZE):
+            merge_m4s_batch_with_ffmpeg(batch)
+    else:
+        # 各子目录相互独立，分发到多个进程并行处理
+        level = logger.getEffectiveLevel()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            submitted = []
+            for item_path in item_paths:
+                # JSON的日志先暂存，与子进程的日志一起按顺序输出
+                json_records, (title, group_title) = _capture_logs(
+                    level, _read_dir_info, item_path)
+                future = executor.submit(
+                    _capture_logs, level, _process_one_dir, item_path,
+                    title, group_title, output_path, process_mode,
+                    audio_output_path)
+                submitted.append((json_records, future))
+            # 按提交顺序输出各子目录的处理日志
+            for json_records, future in submitted:
+                _replay_logs(json_records)
+                try:
+                    records, merge_job = future.result()
+                except Exception as e:
+                    # 子进程异常退出等情况，跳过该子目录
+                    logger.error("子进程处理失败: %s", e)
+                    continue
+                _replay_logs(records)
+                if merge_job:
+                    merge_jobs.append(merge_job)
+
+            # 合并任务按进程数分批，兼顾减少FFmpeg启动次数与并行度
+            batch_size = min(_MERGE_BATCH_SIZE,
+                             -(-len(merge_jobs) // max_workers))
+            futures = [
+                executor.submit(_capture_logs, level,
+                                merge_m4s_batch_with_ffmpeg, batch)
+                for batch in _split_merge_batches(merge_jobs, batch_size)]
+            for future in futures:
+                try:
+                    records, _ = future.result()
+                except Exception as e:
+                    logger.error("子进程合并失败: %s", e)
+                    continue
+                _replay_logs(records)
+    logger.info("目录处理完成。")
 
 
 def clean_Win_illegal_chars(input_path):
-    # 定义非法字符的正则表达式
-    illegal_chars = r'[<>:"/\\|?*]'
-    replace_with = '_'
-    # 替换非法字符为空字符串
-    cleaned_path = re.sub(illegal_chars, replace_with, input_path)
-    return cleaned_path
+    # 替换非法字符为下划线
+    return _WIN_ILLEGAL_CHARS.sub('_', input_path)
 
 
 def test():
@@ -351,8 +799,8 @@ def test():
     with open(file_name, "wb") as f:
         f.write(test_data)
 
-    print("创建测试文件 test.m4s")
-    print("文件内容前9个字节:", test_data[:9])
+    logger.info("创建测试文件 test.m4s")
+    logger.info("文件内容前9个字节: %r", test_data[:9])
 
     # 调用函数
     result = remove_first_9_bytes_if_zero(file_name, file_name+"_modified")
@@ -361,7 +809,7 @@ def test():
     if result:
         with open(file_name+"_modified", "rb") as f:
             modified_data = f.read()
-        print("修改后的文件内容:", modified_data)
+        logger.info("修改后的文件内容: %r", modified_data)
 
 
 def parse_args():
@@ -378,6 +826,14 @@ def parse_args():
                         help="是否只输出音频文件")
     parser.add_argument("--audio_directory", action="store", default=None,
                         help="音频输出目录，默认为基础目录下的bili_audio_output子目录")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="并行处理的子目录数量，默认为CPU核心数")
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument("-q", "--quiet", action="store_true", default=False,
+                           help="只输出警告和错误信息")
+    verbosity.add_argument("-v", "--verbose", action="store_true",
+                           default=False,
+                           help="输出详细的调试信息，包括执行的FFmpeg命令")
     return parser.parse_args()
 
 
@@ -386,6 +842,16 @@ def main():
     Command-line entry
     """
     args = parse_args()
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logging.basicConfig(level=level, format='%(message)s', stream=sys.stdout)
+    # 根日志器已配置过时basicConfig不生效，直接设置本模块日志器的级别
+    logger.setLevel(level)
+
     base_directory = args.base_directory
     output_directory = args.output_directory
     audio_directory = args.audio_directory
@@ -398,7 +864,7 @@ def main():
             process_mode.add("audio")
 
     process_directory(base_directory, output_directory,
-                      process_mode, audio_directory)
+                      process_mode, audio_directory, args.jobs)
 
 
 # 示例用法
@@ -0,0 +1,525 @@
+import ast
+import functools
+import logging
+import multiprocessing
+import os
+import pickle
+import struct
+import subprocess
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import pytest
+
+from bili_video_converter import bili_convert
+from bili_video_converter.bili_convert import remove_first_9_bytes_if_zero
+
+HEADER = b'000000000'
+# 大于1 MiB，覆盖分块复制的多次循环
+PAYLOAD = bytes(range(256)) * 5000
+
+
+@pytest.fixture(autouse=True)
+def reset_module_state(monkeypatch):
+    monkeypatch.setattr(bili_convert, '_made_dirs', set())
+    monkeypatch.setattr(bili_convert, '_media_info_cache', {})
+    level = bili_convert.logger.level
+    yield
+    bili_convert.logger.setLevel(level)
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_strip_in_place(tmp_path):
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    assert remove_first_9_bytes_if_zero(src) is True
+    assert (tmp_path / 'a.m4s').read_bytes() == PAYLOAD
+
+
+def test_strip_to_separate_output(tmp_path):
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    dst = tmp_path / 'b.m4s'
+    dst.write_bytes(b'x' * (len(PAYLOAD) * 2))  # 已有的较长文件应被截断
+    assert remove_first_9_bytes_if_zero(src, str(dst)) is True
+    assert dst.read_bytes() == PAYLOAD
+    assert (tmp_path / 'a.m4s').read_bytes() == HEADER + PAYLOAD
+
+
+def test_no_header_in_place_untouched(tmp_path):
+    data = b'123456789' + PAYLOAD
+    src = write(tmp_path / 'a.m4s', data)
+    assert remove_first_9_bytes_if_zero(src) is False
+    assert (tmp_path / 'a.m4s').read_bytes() == data
+
+
+def test_no_header_copied_to_output(tmp_path):
+    data = b'123456789' + PAYLOAD
+    src = write(tmp_path / 'a.m4s', data)
+    dst = tmp_path / 'b.m4s'
+    assert remove_first_9_bytes_if_zero(src, str(dst)) is False
+    assert dst.read_bytes() == data
+
+
+def test_exactly_nine_bytes(tmp_path):
+    src = write(tmp_path / 'a.m4s', HEADER)
+    assert remove_first_9_bytes_if_zero(src) is True
+    assert (tmp_path / 'a.m4s').read_bytes() == b''
+
+
+def test_too_small(tmp_path):
+    src = write(tmp_path / 'a.m4s', b'0000')
+    assert remove_first_9_bytes_if_zero(src) is False
+    assert (tmp_path / 'a.m4s').read_bytes() == b'0000'
+
+
+def test_wrong_extension(tmp_path):
+    src = write(tmp_path / 'a.mp4', HEADER + PAYLOAD)
+    assert remove_first_9_bytes_if_zero(src) is False
+    assert (tmp_path / 'a.mp4').read_bytes() == HEADER + PAYLOAD
+
+
+def test_missing_file(tmp_path):
+    assert remove_first_9_bytes_if_zero(str(tmp_path / 'none.m4s')) is False
+
+
+def test_output_aliases_input(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for data, expected in ((HEADER + PAYLOAD, PAYLOAD),
+                           (b'123456789' + PAYLOAD, b'123456789' + PAYLOAD)):
+        for output in ('./a.m4s', str(tmp_path / 'a.m4s')):
+            write(tmp_path / 'a.m4s', data)
+            remove_first_9_bytes_if_zero('a.m4s', output)
+            assert (tmp_path / 'a.m4s').read_bytes() == expected
+
+
+def test_output_hardlink_to_input(tmp_path):
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    os.link(src, tmp_path / 'b.m4s')
+    assert remove_first_9_bytes_if_zero(src, str(tmp_path / 'b.m4s')) is True
+    assert (tmp_path / 'a.m4s').read_bytes() == PAYLOAD
+
+
+def test_copy_fallback_without_kernel_copy(tmp_path, monkeypatch):
+    # 模拟不支持copy_file_range和sendfile的平台
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    monkeypatch.setattr(bili_convert.sys, 'platform', 'win32')
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    dst = tmp_path / 'b.m4s'
+    assert remove_first_9_bytes_if_zero(src, str(dst)) is True
+    assert dst.read_bytes() == PAYLOAD
+
+
+def test_find_audio_candidate_skips_dangling_file(tmp_path):
+    small = write(tmp_path / 'small.m4s', b'a' * 10)
+    write(tmp_path / 'large.m4s', b'v' * 100)
+    dangling = tmp_path / 'gone.m4s'
+    dangling.symlink_to(tmp_path / 'missing')
+    files = [str(dangling), small, str(tmp_path / 'large.m4s')]
+    assert bili_convert._find_audio_candidate(files) == small
+    assert bili_convert._find_audio_candidate([str(dangling)]) is None
+
+
+def make_bili_dir(base, name, title, group_title=None,
+                  m4s_names=('30080.m4s', '30280.m4s')):
+    item = base / name
+    item.mkdir()
+    if group_title is None:
+        group_title = title
+    (item / 'videoInfo.json').write_text(
+        '{"title": "%s", "groupTitle": "%s"}' % (title, group_title),
+        encoding='utf-8')
+    for m4s_name in m4s_names:
+        (item / m4s_name).write_bytes(HEADER + m4s_name.encode())
+
+
+def test_process_directory_isolates_failing_subdirectory(tmp_path,
+                                                         monkeypatch):
+    for name in ('1', '2', '3'):
+        make_bili_dir(tmp_path, name, 'T' + name)
+
+    real_strip = bili_convert.remove_first_9_bytes_if_zero
+
+    def strip(path, output_file=None):
+        if os.sep + '2' + os.sep in path:
+            raise OSError('boom')
+        return real_strip(path, output_file)
+
+    merged = []
+    monkeypatch.setattr(bili_convert, 'remove_first_9_bytes_if_zero', strip)
+    monkeypatch.setattr(bili_convert, 'merge_m4s_batch_with_ffmpeg',
+                        merged.extend)
+    bili_convert.process_directory(str(tmp_path), max_workers=1)
+
+    outputs = sorted(os.path.basename(job[2]) for job in merged)
+    assert outputs == ['T1.mp4', 'T3.mp4']
+
+
+def test_batch_merge_maps_video_before_audio(monkeypatch):
+    commands = []
+    monkeypatch.setattr(bili_convert, '_run_ffmpeg',
+                        lambda cmd, *args, **kwargs: commands.append(cmd)
+                        or True)
+    bili_convert.merge_m4s_batch_with_ffmpeg(
+        [('a/30280.m4s', 'a/30080.m4s', 'a.mp4'),
+         ('b/30080.m4s', 'b/30280.m4s', 'b.mp4')])
+
+    cmd = commands[0]
+    assert cmd.count('-probesize') == 4
+    assert '-analyzeduration' not in cmd
+    first = cmd[cmd.index('b/30280.m4s') + 1:cmd.index('a.mp4')]
+    second = cmd[cmd.index('a.mp4') + 1:cmd.index('b.mp4')]
+    assert [arg for arg in first if ':' in arg] == ['0:v?', '1:v?',
+                                                    '0:a?', '1:a?']
+    assert [arg for arg in second if ':' in arg] == ['2:v?', '3:v?',
+                                                     '2:a?', '3:a?']
+
+
+def test_get_media_info_caches_only_success(tmp_path, monkeypatch):
+    path = write(tmp_path / 'a.m4s', b'audio')
+    calls = []
+
+    class Result:
+        stderr = b'error'
+
+        def __init__(self, returncode):
+            self.returncode = returncode
+            self.stdout = (b'{"streams": [{"codec_type": "audio", '
+                           b'"codec_name": "aac"}], "format": '
+                           b'{"duration": "1.0", "bit_rate": "1", '
+                           b'"size": "5"}}')
+
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        return Result(1 if len(calls) == 1 else 0)
+
+    monkeypatch.setattr(bili_convert, '_media_info_cache', {})
+    monkeypatch.setattr(bili_convert.subprocess, 'run', run)
+    assert bili_convert.get_media_info(path) is None
+    assert bili_convert.get_media_info(path)['codec_name'] == 'aac'
+    assert bili_convert.get_media_info(path)['codec_name'] == 'aac'
+    assert len(calls) == 2
+
+    # 文件内容变化（如删除了文件头）后重新探测
+    write(tmp_path / 'a.m4s', b'changed audio')
+    bili_convert.get_media_info(path)
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize('title, m4s_names', [
+    ('T1', ('30280.m4s',)),  # 只有一个.m4s，无法合并
+    ('', ('30080.m4s', '30280.m4s')),  # 标题为空
+])
+def test_no_group_dir_when_nothing_written(tmp_path, monkeypatch,
+                                           title, m4s_names):
+    make_bili_dir(tmp_path, '1', title, 'G', m4s_names)
+    monkeypatch.setattr(bili_convert, 'get_media_info', lambda path: None)
+    monkeypatch.setattr(bili_convert, 'merge_m4s_batch_with_ffmpeg',
+                        lambda jobs: True)
+    bili_convert.process_directory(str(tmp_path),
+                                   process_mode={'video', 'audio'},
+                                   max_workers=1)
+
+    assert os.listdir(tmp_path / 'bili_video_output') == []
+    assert os.listdir(tmp_path / 'bili_audio_output') == []
+
+
+def test_group_dir_created_for_merge_job(tmp_path, monkeypatch):
+    make_bili_dir(tmp_path, '1', 'T1', 'G')
+    merged = []
+    monkeypatch.setattr(bili_convert, 'merge_m4s_batch_with_ffmpeg',
+                        merged.extend)
+    bili_convert.process_directory(str(tmp_path), max_workers=1)
+
+    assert [os.path.basename(job[2]) for job in merged] == ['T1.mp4']
+    assert os.path.isdir(tmp_path / 'bili_video_output' / 'G')
+
+
+FAKE_FFMPEG = """#!{python}
+import os, sys
+args = sys.argv[1:]
+with open(os.environ['FAKE_FFMPEG_LOG'], 'a', encoding='utf-8') as log:
+    log.write(repr(args) + '\\n')
+# 输出文件为不跟在-i之后、以输出扩展名结尾的参数
+for i, arg in enumerate(args):
+    if arg.endswith(('.mp4', '.m4a')) and args[i - 1] != '-i':
+        open(arg, 'wb').close()
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    ffmpeg = bin_dir / 'ffmpeg'
+    ffmpeg.write_text(FAKE_FFMPEG.format(python=sys.executable),
+                      encoding='utf-8')
+    ffmpeg.chmod(0o755)
+    log = tmp_path / 'ffmpeg.log'
+    log.touch()
+    monkeypatch.setenv('PATH', str(bin_dir) + os.pathsep +
+                       os.environ.get('PATH', ''))
+    monkeypatch.setenv('FAKE_FFMPEG_LOG', str(log))
+    return log
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake ffmpeg is a shebang script')
+@pytest.mark.parametrize('start_method', [
+    method for method in ('fork', 'spawn')
+    if method in multiprocessing.get_all_start_methods()])
+def test_process_directory_parallel(tmp_path, monkeypatch, caplog,
+                                    fake_ffmpeg, start_method):
+    base = tmp_path / 'base'
+    base.mkdir()
+    names = [str(i) for i in range(1, 6)]
+    for name in names:
+        make_bili_dir(base, name, 'T' + name, 'G')
+    monkeypatch.setattr(
+        bili_convert, 'ProcessPoolExecutor',
+        functools.partial(ProcessPoolExecutor,
+                          mp_context=multiprocessing.get_context(
+                              start_method)))
+    caplog.set_level(logging.INFO, logger=bili_convert.logger.name)
+
+    bili_convert.process_directory(str(base), max_workers=2)
+
+    # 文件头均已删除
+    for name in names:
+        for m4s_name in ('30080.m4s', '30280.m4s'):
+            assert not (base / name / m4s_name).read_bytes().startswith(
+                HEADER)
+
+    # 每个视频恰好合并一次
+    outputs = []
+    for line in fake_ffmpeg.read_text(encoding='utf-8').splitlines():
+        args = ast.literal_eval(line)
+        outputs += [os.path.basename(arg) for arg in args
+                    if arg.endswith('.mp4')]
+    assert sorted(outputs) == sorted('T%s.mp4' % name for name in names)
+    for name in names:
+        assert (base / 'bili_video_output' / 'G' / ('T%s.mp4' % name)).exists()
+
+    # 子进程的日志按子目录顺序回放，且同一子目录的日志相邻
+    owners = []
+    for record in caplog.records:
+        for name in names:
+            if os.path.join(str(base), name) in record.getMessage():
+                owners.append(name)
+    collapsed = [name for i, name in enumerate(owners)
+                 if i == 0 or owners[i - 1] != name]
+    assert len(collapsed) == len(names)
+    assert set(collapsed) == set(names)
+    assert any('处理文件' in record.getMessage() for record in caplog.records)
+
+
+class FailingExecutor:
+    """同步执行的执行器，对包含指定目录的任务返回异常的Future"""
+
+    def __init__(self, max_workers, fail_on):
+        self.fail_on = fail_on
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, func, *args):
+        future = Future()
+        if any(self.fail_on in str(arg) for arg in args):
+            future.set_exception(RuntimeError('worker died'))
+        else:
+            future.set_result(func(*args))
+        return future
+
+
+def test_process_directory_parallel_tolerates_failed_future(tmp_path,
+                                                            monkeypatch):
+    for name in ('1', '2', '3'):
+        make_bili_dir(tmp_path, name, 'T' + name)
+    merged = []
+    monkeypatch.setattr(
+        bili_convert, 'ProcessPoolExecutor',
+        functools.partial(FailingExecutor,
+                          fail_on=os.path.join(str(tmp_path), '2')))
+    monkeypatch.setattr(bili_convert, 'merge_m4s_batch_with_ffmpeg',
+                        merged.extend)
+    bili_convert.process_directory(str(tmp_path), max_workers=2)
+
+    outputs = sorted(os.path.basename(job[2]) for job in merged)
+    assert outputs == ['T1.mp4', 'T3.mp4']
+
+
+def log_some(unpicklable):
+    bili_convert.logger.debug("debug %s", unpicklable)
+    bili_convert.logger.info("info %s", unpicklable)
+    bili_convert.logger.warning("warning")
+    return 42
+
+
+def test_capture_logs_records_pickle():
+    records, result = bili_convert._capture_logs(
+        logging.DEBUG, log_some, lambda: None)
+    assert result == 42
+    restored = pickle.loads(pickle.dumps(records))
+    assert [r.levelno for r in restored] == [logging.DEBUG, logging.INFO,
+                                             logging.WARNING]
+    assert restored[1].getMessage().startswith('info <function')
+
+
+def test_capture_logs_honours_level_and_restores_logger(caplog):
+    logger = bili_convert.logger
+    logger.setLevel(logging.DEBUG)
+    records, _ = bili_convert._capture_logs(logging.WARNING, log_some, 1)
+    assert [r.getMessage() for r in records] == ['warning']
+    # 捕获期间不向上传播，结束后恢复原有配置
+    assert caplog.records == []
+    assert logger.level == logging.DEBUG
+    assert logger.propagate is True
+    assert not any(isinstance(h, bili_convert._RecordCollector)
+                   for h in logger.handlers)
+
+
+@pytest.mark.skipif(os.name == 'nt', reason='fake ffmpeg is a shebang script')
+@pytest.mark.parametrize('flags, expect_info', [([], True), (['-q'], False)])
+def test_quiet_suppresses_worker_info(tmp_path, monkeypatch, caplog,
+                                      fake_ffmpeg, flags, expect_info):
+    base = tmp_path / 'base'
+    base.mkdir()
+    for name in ('1', '2'):
+        make_bili_dir(base, name, 'T' + name)
+    monkeypatch.setattr(sys, 'argv',
+                        ['bili-converter', str(base), '-j', '2'] + flags)
+    bili_convert.main()
+
+    ours = [r for r in caplog.records
+            if r.name == bili_convert.logger.name]
+    worker_info = [r for r in ours if r.levelno == logging.INFO and
+                   '处理文件' in r.getMessage()]
+    assert bool(worker_info) is expect_info
+    if not expect_info:
+        assert all(r.levelno >= logging.WARNING for r in ours)
+
+
+def box(box_type, payload):
+    return struct.pack('>I', 8 + len(payload)) + box_type + payload
+
+
+def fmp4(handler_type, padding=b''):
+    # hdlr: version/flags、pre_defined、handler_type、reserved、name
+    hdlr = box(b'hdlr', b'\0' * 4 + b'\0' * 4 + handler_type +
+               b'\0' * 12 + b'name\0')
+    moov = box(b'moov', box(b'trak', box(b'mdia', hdlr)))
+    return box(b'ftyp', b'iso5' * 3) + padding + moov
+
+
+@pytest.mark.parametrize('data, expected', [
+    (fmp4(b'vide'), 'video'),
+    (fmp4(b'soun'), 'audio'),
+    (HEADER + fmp4(b'soun'), 'audio'),  # 尚未删除的9字节文件头
+    (fmp4(b'subt'), None),
+    (box(b'ftyp', b'iso5' * 3) + box(b'mdat', b'x' * 100), None),
+    (b'', None),
+])
+def test_detect_m4s_kind(tmp_path, data, expected):
+    path = write(tmp_path / 'a.m4s', data)
+    assert bili_convert._detect_m4s_kind(path) == expected
+
+
+def test_detect_m4s_kind_scan_limit(tmp_path):
+    limit = bili_convert._HDLR_SCAN_LIMIT
+    inside = write(tmp_path / 'in.m4s',
+                   fmp4(b'soun', box(b'free', b'\0' * (limit - 200))))
+    outside = write(tmp_path / 'out.m4s',
+                    fmp4(b'soun', box(b'free', b'\0' * limit)))
+    assert bili_convert._detect_m4s_kind(inside) == 'audio'
+    assert bili_convert._detect_m4s_kind(outside) is None
+
+
+def test_detect_m4s_kind_missing_file(tmp_path):
+    assert bili_convert._detect_m4s_kind(str(tmp_path / 'none.m4s')) is None
+
+
+def test_copy_range_zero_return_falls_back(tmp_path, monkeypatch):
+    # 内核复制返回0时应改用其他方式，而不是留下被截断的输出
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0,
+                        raising=False)
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0, raising=False)
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    dst = tmp_path / 'b.m4s'
+    assert remove_first_9_bytes_if_zero(src, str(dst)) is True
+    assert dst.read_bytes() == PAYLOAD
+
+
+def test_copy_range_short_source_raises(tmp_path, monkeypatch):
+    monkeypatch.delattr(os, 'copy_file_range', raising=False)
+    monkeypatch.setattr(bili_convert.sys, 'platform', 'win32')
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    src_fd = os.open(src, os.O_RDONLY)
+    dst_fd = os.open(str(tmp_path / 'b.m4s'), os.O_WRONLY | os.O_CREAT)
+    try:
+        with pytest.raises(OSError):
+            bili_convert._copy_range(src_fd, dst_fd, 9, len(PAYLOAD) + 1)
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+
+def test_strip_in_place_without_mmap(tmp_path, monkeypatch):
+    # 模拟不支持可写共享映射的文件系统
+    def no_mmap(*args, **kwargs):
+        raise OSError('mmap not supported')
+
+    monkeypatch.setattr(bili_convert.mmap, 'mmap', no_mmap)
+    src = write(tmp_path / 'a.m4s', HEADER + PAYLOAD)
+    assert remove_first_9_bytes_if_zero(src) is True
+    assert (tmp_path / 'a.m4s').read_bytes() == PAYLOAD
+
+
+@pytest.mark.parametrize('error, expected_calls', [
+    (FileNotFoundError('ffmpeg'), 1),
+    (subprocess.TimeoutExpired('ffmpeg', 1), 1),
+    (None, 3),
+])
+def test_batch_merge_retries_only_on_ffmpeg_failure(monkeypatch, error,
+                                                    expected_calls):
+    calls = []
+
+    def run(cmd, **kwargs):
+        calls.append(cmd)
+        if error is not None:
+            raise error
+        return subprocess.CompletedProcess(cmd, 1, stderr=b'bad input')
+
+    monkeypatch.setattr(bili_convert.subprocess, 'run', run)
+    jobs = [('a/30080.m4s', 'a/30280.m4s', 'a.mp4'),
+            ('b/30080.m4s', 'b/30280.m4s', 'b.mp4')]
+    assert bili_convert.merge_m4s_batch_with_ffmpeg(jobs) is False
+    assert len(calls) == expected_calls
+
+
+def test_split_merge_batches_count_limit():
+    jobs = [(f'{i}/v.m4s', f'{i}/a.m4s', f'{i}.mp4') for i in range(7)]
+    batches = list(bili_convert._split_merge_batches(jobs, 3))
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [job for batch in batches for job in batch] == jobs
+
+
+def test_split_merge_batches_cmdline_limit():
+    # 每个任务约占命令行长度限制的三分之一
+    length = bili_convert._MAX_CMDLINE_LENGTH // 9
+    jobs = [(str(i) * length, str(i) * length, str(i) * length)
+            for i in range(5)]
+    batches = list(bili_convert._split_merge_batches(jobs, 30))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    for batch in batches:
+        total = sum(sum(map(len, job)) + bili_convert._MERGE_JOB_OVERHEAD
+                    for job in batch)
+        assert total <= bili_convert._MAX_CMDLINE_LENGTH
+
+    # 单个任务超过限制时仍单独成批，而不是丢弃
+    huge = ('v' * bili_convert._MAX_CMDLINE_LENGTH, 'a', 'o')
+    assert list(bili_convert._split_merge_batches([huge, huge], 30)) == \
+        [[huge], [huge]]